@@ -36,7 +36,7 @@ parser.add_argument('--depth', default=26, type=int)
 parser.add_argument('--width', default=1, type=int)
 parser.add_argument('--batch_size', default=128, type=int)
 parser.add_argument('--group_norm', default=0, type=int)
-parser.add_argument('--workers', default=0, type=int)
+parser.add_argument('--workers', default=4, type=int)
 parser.add_argument('--num_sample', default=1000000, type=int)
 ########################################################################
 parser.add_argument('--lr', default=0.001, type=float)
@@ -61,6 +61,8 @@ parser.add_argument('--save_every', default=100, type=int)
 parser.add_argument('--tsne', action='store_true')
 ########################################################################
 parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--compile', action='store_true', help='compile the adaptation model with torch.compile')
+parser.add_argument('--cuda_graph', action='store_true', help='replay adaptation steps from a captured cuda graph')
 
 args = parser.parse_args()
 
@@ -91,9 +93,7 @@ _, trloader = prepare_test_data(args, num_sample=args.num_sample)
 print('Resuming from %s...' %(args.resume))
 
 load_resnet50(net, head, ssh, classifier, args)
-
-if torch.cuda.device_count() > 1:
-    ext = torch.nn.DataParallel(ext)
+net = net.to(memory_format=torch.channels_last)
 
 # ----------- Test ------------
 
@@ -112,6 +112,14 @@ print('Running...')
 
 print("Test-time adaptation: BNM")
 bnm_model = setup_bnm(net, args)
+if args.cuda_graph:
+    # already graph-captured, so not combined with torch.compile.
+    # capture on a dummy batch: iterating teloader would start its workers
+    # and shift the shuffle order of the run
+    bnm_model.capture(torch.randn(args.batch_size, 3, 32, 32).pin_memory())
+elif args.compile:
+    # fixed batch size: static shapes let inductor capture cuda graphs
+    bnm_model = torch.compile(bnm_model, mode='reduce-overhead', fullgraph=False, dynamic=False)
 bnm_model.eval()
 
 print('Error (%)\t\ttest\t\tbnm')
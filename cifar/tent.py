@@ -36,7 +36,7 @@ parser.add_argument('--depth', default=26, type=int)
 parser.add_argument('--width', default=1, type=int)
 parser.add_argument('--batch_size', default=128, type=int)
 parser.add_argument('--group_norm', default=0, type=int)
-parser.add_argument('--workers', default=0, type=int)
+parser.add_argument('--workers', default=4, type=int)
 parser.add_argument('--num_sample', default=1000000, type=int)
 ########################################################################
 parser.add_argument('--lr', default=0.001, type=float)
@@ -61,6 +61,7 @@ parser.add_argument('--save_every', default=100, type=int)
 parser.add_argument('--tsne', action='store_true')
 ########################################################################
 parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--compile', action='store_true', help='compile the adaptation model with torch.compile')
 
 args = parser.parse_args()
 
@@ -92,9 +93,6 @@ print('Resuming from %s...' %(args.resume))
 
 load_resnet50(net, head, ssh, classifier, args)
 
-if torch.cuda.device_count() > 1:
-    ext = torch.nn.DataParallel(ext)
-
 # ----------- Test ------------
 
 if args.tsne:
@@ -112,8 +110,19 @@ print('Running...')
 
 print("Test-time adaptation: TENT")
 tent_model = setup_tent(net, args)
+if args.compile:
+    # fixed batch size: static shapes let inductor capture cuda graphs
+    tent_model = torch.compile(tent_model, mode='reduce-overhead', fullgraph=False, dynamic=False)
 tent_model.eval()
 
+# the corrupted samples are fixed across epochs: keep them on the gpu if they fit
+inputs_tr = preload_inputs(trloader)
+if inputs_tr is None:
+    print('Stream samples for adaptation from the data loader')
+else:
+    # release the persistent workers and the host copy of the samples
+    del trloader
+
 print('Error (%)\t\ttest\t\ttent')
 err_cls = test(teloader, net)[0]
 print(('Epoch %d/%d:' %(0, args.nepoch)).ljust(24) +
@@ -127,7 +136,10 @@ for epoch in range(1, args.nepoch+1):
     
     tic = time.time()
 
-    _ = test(trloader, tent_model)[0]
+    if inputs_tr is not None:
+        adapt_only_preloaded(inputs_tr, args.batch_size, tent_model)
+    else:
+        adapt_only(trloader, tent_model)
 
     err_cls = test(teloader, net)[0]
     all_err_cls.append(err_cls)
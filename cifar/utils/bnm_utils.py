@@ -2,7 +2,6 @@ from copy import deepcopy
 
 import torch
 import torch.nn as nn
-import torch.jit
 import torch.optim as optim
 import torch.nn.functional as F
 
@@ -17,23 +16,86 @@ class BNM(nn.Module):
         self.steps = steps
         assert steps > 0, "BNM requires >= 1 step(s) to forward and update"
         self.episodic = episodic
+        # loss scaling keeps the fp16 gradients of the autocast forward from underflowing
+        self.scaler = make_grad_scaler()
 
         # note: if the model is never reset, like for continual adaptation,
-        # then skipping the state copy would save memory
-        self.model_state, self.optimizer_state = \
+        # then skipping the state copy saves memory
+        self.model_state, self.optimizer_state = (None, None) if not episodic else \
             copy_model_and_optimizer(self.model, self.optimizer)
 
+        # set by capture(): cuda graph of one adaptation step + its buffers
+        self.graph = None
+        self.static_x = None
+        self.static_outputs = None
+
     def forward(self, x):
         if self.episodic:
             self.reset()
 
-        for _ in range(self.steps):
-            forward_and_adapt(x, self.model, self.optimizer)
+        # no train/eval switch: batch norm is the only mode-dependent layer and
+        # configure_model makes it use batch statistics in either mode
+        if self.graph is not None and x.shape == self.static_x.shape:
+            self.static_x.copy_(x, non_blocking=True)
+            for _ in range(self.steps):
+                self.graph.replay()
+            outputs = self.static_outputs.clone()
+        else:
+            for _ in range(self.steps):
+                outputs = forward_and_adapt(x, self.model, self.optimizer, self.scaler)
 
-        outputs = forward_only(x, self.model)
+        # a single step returns the outputs of its own forward, taken before
+        # optimizer.step(): like Tent, predictions lag one update behind, so
+        # reported errors differ from a post-update forward. More steps still
+        # end with a forward on the updated model.
+        if self.steps > 1:
+            outputs = forward_only(x, self.model)
 
         return outputs
 
+    def capture(self, x):
+        """Capture one adaptation step on batches shaped like x in a CUDA graph.
+        Later forwards on batches of the same shape replay the graph, other
+        shapes (e.g. a smaller last batch) run eagerly.
+        The optimizer must be capturable and fused, see setup_optimizer:
+        only the fused Adam step applies the loss scale without a host sync.
+        """
+        assert not self.episodic, "BNM cannot reset a captured optimizer state"
+        assert all(group.get('fused') and group['capturable']
+                   for group in self.optimizer.param_groups), \
+            "BNM capture needs a fused, capturable optimizer"
+        params = [p for group in self.optimizer.param_groups
+                  for p in group['params'] if p.requires_grad]
+        backup = [p.detach().clone() for p in params]
+        scaler_state = self.scaler.state_dict()
+        self.static_x = torch.empty_like(x, device='cuda',
+                                         memory_format=torch.channels_last)
+        self.static_x.copy_(x)
+
+        # warm up on a side stream, which also allocates the optimizer state
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                forward_and_adapt(self.static_x, self.model, self.optimizer, self.scaler)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        # undo the warm-up updates in place: the graph records these storages
+        with torch.no_grad():
+            for p, b in zip(params, backup):
+                p.copy_(b)
+            for state in self.optimizer.state.values():
+                for v in state.values():
+                    if torch.is_tensor(v):
+                        v.zero_()
+        # refills the scale and growth tracker in place, like a fresh scaler
+        self.scaler.load_state_dict(scaler_state)
+
+        self.graph = torch.cuda.CUDAGraph()
+        # thread_local: loader pin_memory threads may still run during capture
+        with torch.cuda.graph(self.graph, capture_error_mode='thread_local'):
+            self.static_outputs = forward_and_adapt(self.static_x, self.model, self.optimizer, self.scaler)
+
     def reset(self):
         if self.model_state is None or self.optimizer_state is None:
             raise Exception("cannot reset without saved model/optimizer state")
@@ -46,36 +108,52 @@ class BNM(nn.Module):
 #     """Entropy of softmax distribution from logits."""
 #     return -(x.softmax(1) * x.log_softmax(1)).sum(1)
 
-@torch.jit.script
 def batch_nuclear_norm(x: torch.Tensor) -> torch.Tensor:
-    """Nuclear norm of output matrix."""
-    target_softmax = F.softmax(x, dim=1)
-    #return -torch.norm(target_softmax,'nuc')/target_softmax.shape[0]
-    return -torch.sqrt(torch.mean(torch.svd(target_softmax)[1]**2))
+    """Nuclear norm of output matrix.
+    The sum of squared singular values equals the squared Frobenius norm,
+    so their mean is computed without an SVD.
+    """
+    #return -torch.norm(F.softmax(x, dim=1),'nuc')/x.shape[0]
+    rank = min(x.shape[0], x.shape[1])
+    p = F.softmax(x, dim=1)
+    return -torch.sqrt((p * p).sum() / rank)
 
 @torch.enable_grad()  # ensure grads in possible no grad context for testing
-def forward_and_adapt(x, model, optimizer):
+def forward_and_adapt(x, model, optimizer, scaler):
     """Forward and adapt model on batch of data.
     Measure Nuclear normalization of the model prediction, take gradients, and update params.
+    Batch statistics are used regardless of train/eval mode, see configure_model.
     """
-    model.train() ## !!
-    # forward
-    outputs = model(x)
+    x = x.contiguous(memory_format=torch.channels_last)
+    # forward, without the autocast weight cache which cuda graphs cannot use
+    with torch.autocast('cuda', dtype=torch.float16, cache_enabled=False):
+        outputs = model(x)
+    outputs = outputs.float()
     # adapt
     loss = batch_nuclear_norm(outputs)
-    loss.backward()
-    optimizer.step()
-    optimizer.zero_grad()
-    return outputs
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad(set_to_none=True)
+    return outputs.detach()
 
 def forward_only(x, model):
     """Forward model on batch of data.
     """
-    model.eval()
-    with torch.no_grad():
+    x = x.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode():
         # forward
-        outputs = model(x)
-    return outputs
+        with torch.autocast('cuda', dtype=torch.float16):
+            outputs = model(x)
+    return outputs.float()
+
+
+def make_grad_scaler():
+    """Create a CUDA gradient scaler for the fp16 adaptation forward."""
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    # older PyTorch only has the CUDA-specific scaler
+    return torch.cuda.amp.GradScaler()
 
 
 def collect_params(model, bn_only=True):
@@ -94,11 +172,9 @@ def collect_params(model, bn_only=True):
     if bn_only:
         # Collect only BatchNorm parameters
         for nm, m in model.named_modules():
-            if isinstance(m, nn.BatchNorm2d):
-                for np, p in m.named_parameters():
-                    if np in ['weight', 'bias']:  # weight is scale, bias is shift
-                        params.append(p)
-                        names.append(f"{nm}.{np}")
+            if isinstance(m, nn.BatchNorm2d) and m.affine:
+                params += [m.weight, m.bias]  # weight is scale, bias is shift
+                names += [f"{nm}.weight", f"{nm}.bias"]
     else:
         # Collect all parameters
         for nm, p in model.named_parameters():
@@ -131,7 +207,8 @@ def configure_model(model):
     for m in model.modules():
         if isinstance(m, nn.BatchNorm2d):
             m.requires_grad_(True)
-            # force use of batch stats in train and eval modes
+            # force use of batch stats in train and eval modes: without
+            # running buffers F.batch_norm is called with training=True
             m.track_running_stats = False
             m.running_mean = None
             m.running_var = None
@@ -178,7 +255,22 @@ def setup_optimizer(params, args):
     trainig, if known, or start with a low learning rate (like 0.001) if not.
     For best results, try tuning the learning rate and batch size.
     """
-    return optim.Adam(params,
-                      lr=args.lr,
-                      betas=(0.9, 0.999),
-                      weight_decay=0.)
+    params = list(params)
+    # keep the step count on device so the update can be captured, see BNM.capture
+    capturable = getattr(args, 'cuda_graph', False)
+    try:
+        # single multi-tensor kernel for the many small BN params
+        return optim.Adam(params,
+                          lr=args.lr,
+                          betas=(0.9, 0.999),
+                          weight_decay=0.,
+                          fused=all(p.is_cuda for p in params),
+                          capturable=capturable)
+    except TypeError:
+        # older PyTorch without fused Adam
+        return optim.Adam(params,
+                          lr=args.lr,
+                          betas=(0.9, 0.999),
+                          weight_decay=0.,
+                          foreach=True,
+                          capturable=capturable)
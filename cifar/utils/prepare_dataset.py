@@ -208,9 +208,16 @@ def prepare_test_data(args, ttt=False, num_sample=None):
         teset.data = teset.data[:num_sample]
         print("Truncate the test set to {:d} samples".format(num_sample))
 
+    # keep workers alive across epochs, test loaders are re-iterated every epoch
+    if hasattr(args, 'workers') and args.workers > 0:
+        worker_kwargs = {'persistent_workers': True, 'prefetch_factor': 4}
+    else:
+        worker_kwargs = {}
+
     teloader = torch.utils.data.DataLoader(teset, batch_size=args.batch_size,
                                             shuffle=shuffle, num_workers=args.workers,
-                                            worker_init_fn=seed_worker, pin_memory=pin_memory, drop_last=drop_last)
+                                            worker_init_fn=seed_worker, pin_memory=pin_memory, drop_last=drop_last,
+                                            **worker_kwargs)
     return teset, teloader
 
 def prepare_train_data(args, num_sample=None):
@@ -7,7 +7,6 @@ from copy import deepcopy
 
 import torch
 import torch.nn as nn
-import torch.jit
 import torch.optim as optim
 
 class Tent(nn.Module):
@@ -23,8 +22,8 @@ class Tent(nn.Module):
         self.episodic = episodic
 
         # note: if the model is never reset, like for continual adaptation,
-        # then skipping the state copy would save memory
-        self.model_state, self.optimizer_state = \
+        # then skipping the state copy saves memory
+        self.model_state, self.optimizer_state = (None, None) if not episodic else \
             copy_model_and_optimizer(self.model, self.optimizer)
 
     def forward(self, x):
@@ -43,7 +42,6 @@ class Tent(nn.Module):
                                  self.model_state, self.optimizer_state)
 
 
-@torch.jit.script
 def softmax_entropy(x: torch.Tensor) -> torch.Tensor:
     """Entropy of softmax distribution from logits."""
     return -(x.softmax(1) * x.log_softmax(1)).sum(1)
@@ -61,7 +59,7 @@ def forward_and_adapt(x, model, optimizer):
     loss = softmax_entropy(outputs).mean(0)
     loss.backward()
     optimizer.step()
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
     return outputs
 
 
@@ -152,7 +150,18 @@ def setup_optimizer(params, args):
     trainig, if known, or start with a low learning rate (like 0.001) if not.
     For best results, try tuning the learning rate and batch size.
     """
-    return optim.Adam(params,
-                      lr=args.lr,
-                      betas=(0.9, 0.999),
-                      weight_decay=0.)
\ No newline at end of file
+    params = list(params)
+    try:
+        # single multi-tensor kernel for the many small BN params
+        return optim.Adam(params,
+                          lr=args.lr,
+                          betas=(0.9, 0.999),
+                          weight_decay=0.,
+                          fused=all(p.is_cuda for p in params))
+    except TypeError:
+        # older PyTorch without fused Adam
+        return optim.Adam(params,
+                          lr=args.lr,
+                          betas=(0.9, 0.999),
+                          weight_decay=0.,
+                          foreach=True)
\ No newline at end of file
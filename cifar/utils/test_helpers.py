@@ -161,15 +161,44 @@ def test(dataloader, model, sslabel=None):
         with torch.no_grad():
             outputs = model(inputs)
             loss = criterion(outputs, labels)
-            losses.append(loss.cpu())
+            losses.append(loss)
             _, predicted = outputs.max(1)
-            correct.append(predicted.eq(labels).cpu())
-    correct = torch.cat(correct).numpy()
-    losses = torch.cat(losses).numpy()
+            correct.append(predicted.eq(labels))
+    # keep the tallies on device and sync once, instead of once per batch
+    correct = torch.cat(correct).cpu().numpy()
+    losses = torch.cat(losses).cpu().numpy()
     model.train()
     return 1-correct.mean(), correct, losses
 
 
+def adapt_only(dataloader, model):
+    model.eval()
+    with torch.no_grad():
+        for inputs, _ in dataloader:
+            model(inputs.cuda(non_blocking=True))
+    model.train()
+
+
+def preload_inputs(dataloader, max_fraction=0.5):
+    # cache all inputs on the gpu, or None if they would not fit comfortably
+    dataset = dataloader.dataset
+    sample = dataset[0][0]
+    nbytes = len(dataset) * sample.numel() * sample.element_size()
+    free, _ = torch.cuda.mem_get_info()
+    if nbytes > max_fraction * free:
+        return None
+    return torch.cat([inputs for inputs, _ in dataloader]).cuda()
+
+
+def adapt_only_preloaded(inputs, batch_size, model):
+    model.eval()
+    perm = torch.randperm(inputs.size(0), device=inputs.device)
+    with torch.no_grad():
+        for idx in perm.split(batch_size):
+            model(inputs[idx])
+    model.train()
+
+
 def test_grad_corr(dataloader, net, ssh, ext):
     criterion = nn.CrossEntropyLoss().cuda()
     net.eval()